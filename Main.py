@@ -14,8 +14,17 @@ import websockets
 import json
 import asyncio
 import pickle
+import math
+import statistics
+from concurrent.futures import ProcessPoolExecutor
 from tempfile import TemporaryDirectory
 
+# numpy is only needed for the --loudness and --normalize options.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 __version__ = '0.8.2'
 
 # Creates a shuffled MSU-1 pack for ALttP Randomizer from one or more source
@@ -34,7 +43,9 @@ __version__ = '0.8.2'
 #        on top of Main.py to open the ROMs with the python script; for each ROM
 #        opened this way, a shuffled MSU pack matching that ROM's name will be
 #        generated next to the ROM in its original directory (with the tracklist
-#        in ROMNAME-msushuffleroutput.log).
+#        in ROMNAME-msushuffleroutput.log, and a machine-readable version with
+#        the source path, pack and selection details of every track in
+#        ROMNAME-msushuffleroutput.json).
 #
 # 3) MANUAL METHOD:
 #
@@ -64,7 +75,11 @@ __version__ = '0.8.2'
 #        line as "python Main.py --live 10 --nowplaying" to run in live
 #        reshuffle mode (as described above) while polling qusb2snes for
 #        the currently playing MSU pack, printed to console and nowplaying.txt
-#        for use as an OBS streaming text source.
+#        for use as an OBS streaming text source.  If several emulators or
+#        consoles are connected to qusb2snes, all of them are polled, and
+#        each additional device gets its own nowplaying-2.txt,
+#        nowplaying-3.txt, etc.  The current dungeon or overworld screen is
+#        written on the line after the pack name.
 #
 # 4) Load the ROM in an MSU-compatible emulator (works well with Snes9x 1.60)
 #
@@ -107,6 +122,22 @@ __version__ = '0.8.2'
 #   file name; useful for keeping tracks hidden from the shuffler without
 #   needing to move them out of the collection entirely.
 #
+# - If run in the command line as "python Main.py --loudness 6" (or any other
+#   number of dB), each track is only picked from source tracks whose RMS
+#   loudness is within that many dB of the median loudness of all indexed
+#   tracks, to avoid jumping between very quiet and very loud packs.  Falls
+#   back to any matching track if none are within range.
+#
+# - If run in the command line as "python Main.py --realcopy --normalize",
+#   each copied track has its gain adjusted towards the median loudness of all
+#   indexed tracks (quiet tracks are only boosted as far as they can be
+#   without clipping).
+#
+# - --loudness and --normalize require numpy.  The loudness of each track is
+#   analysed the first time either option is used and cached in
+#   ./trackloudness.pkl; only new or changed tracks are analysed on later
+#   runs.
+#
 # - Caches the track list in ./trackindex.pkl to avoid reindexing the entire
 #   collection every time the script is run.  If run in the command line as
 #   "python Main.py --reindex", it will regenerate the track index.  Use this
@@ -253,6 +284,10 @@ extendedbackupdict = {
 
 higandir = "./higan.sfc"
 
+# Number of 16-bit samples handled at a time when analysing or normalizing a
+# track, to keep memory use flat for long tracks.
+ANALYSIS_BLOCK = 1 << 20
+
 # Globals used by the scheduled reshuffle in live mode (couldn't figure out
 # a better way to pass dicts/lists to shuffle_all_tracks when called by
 # the scheduler)
@@ -264,21 +299,172 @@ global loopingfoundtracks
 loopingfoundtracks = list()
 global shuffledloopingfoundtracks
 shuffledloopingfoundtracks = list()
+global loudnessindex
+loudnessindex = {}
+global loudnessbounds
+loudnessbounds = None
+global normalizetarget
+normalizetarget = None
+# Manifest of the most recently generated pack for each ROM, used by the now
+# playing view and to keep track of tracks that failed to be replaced.
+global manifests
+manifests = {}
 s = sched.scheduler(time.time, time.sleep)
 
-def delete_old_msu(args, rompath):
-    try:
-        if os.path.exists(f"{rompath}-msushuffleroutput.log"):
-            os.remove(f"{rompath}-msushuffleroutput.log")
-    except PermissionError:
-        print(f"WARNING: Failed to clear old logfile {rompath}-msushuffleroutput.log")
+# Connections to every SNES device attached through qusb2snes, kept open
+# between now playing polls.
+global snesdevices
+snesdevices = list()
+
+WRAM_START = 0xF50000
+
+# WRAM ranges read from every device on each now playing poll, batched into
+# a single GetAddress request per device.  Current MSU is $010B, per
+# https://github.com/KatDevsGames/z3randomizer/blob/master/msu.asm#L126
+nowplayingreads = [
+  ("track", 0x010B, 1),     # Current MSU track
+  ("module", 0x0010, 1),    # Main game module (0x07 dungeon, 0x09 overworld)
+  ("overworld", 0x008A, 1), # Current overworld screen
+  ("dungeon", 0x040C, 1)]   # Current dungeon (0xFF in caves)
+
+dungeonnames = {
+  0x00: "Sewers",
+  0x02: "Hyrule Castle",
+  0x04: "Eastern Palace",
+  0x06: "Desert Palace",
+  0x08: "Agahnim's Tower",
+  0x0A: "Swamp Palace",
+  0x0C: "Palace of Darkness",
+  0x0E: "Misery Mire",
+  0x10: "Skull Woods",
+  0x12: "Ice Palace",
+  0x14: "Tower of Hera",
+  0x16: "Thieves' Town",
+  0x18: "Turtle Rock",
+  0x1A: "Ganon's Tower"}
+
+# Each generated pack gets a manifest recording where every track came from,
+# built in memory while the pack is generated and written out once it's
+# complete as ROMNAME-msushuffleroutput.json, along with the human-readable
+# tracklist in ROMNAME-msushuffleroutput.log.
+#
+# Manifest format:
+# manifest['tracks'][2] = {'track': 2, 'title': '2 - Light World Overworld',
+#                          'source': '../msu1/track-2.pcm', 'pack': 'msu1',
+#                          'srctrack': 2, 'looping': True, 'candidates': 4,
+#                          'rms': -18.3, 'gain': 0, 'copied': True}
+def new_manifest(args, rompath):
+    return {
+        'version': __version__,
+        'rom': rompath,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'options': {
+            'fullshuffle': args.fullshuffle,
+            'basicshuffle': args.basicshuffle,
+            'singleshuffle': args.singleshuffle,
+            'higan': args.higan,
+            'realcopy': args.forcerealcopy,
+            'live': args.live,
+            'loudness': args.loudness,
+            'normalize': args.normalize,
+            'dry_run': args.dry_run,
+        },
+        'log': list(),
+        'tracks': {},
+    }
 
-    logger = logging.getLogger('')
-    output_file_handler = logging.FileHandler(f"{rompath}-msushuffleroutput.log")
-    logger.addHandler(output_file_handler)
+# Log a message to the console and to the manifest's tracklist.
+def log_line(manifest, msg):
+    logging.getLogger('').info(msg)
+    manifest['log'].append(msg)
+
+# Name of the pack directory a track was found in, relative to the search
+# directory.
+def pack_name(path):
+    path_parts = list()
+    while True:
+        parts = os.path.split(path)
+        if parts[0] == path:
+            path_parts.insert(0, parts[0])
+            break
+        elif parts[1] == path:
+            path_parts.insert(0, parts[1])
+            break
+        else:
+            path = parts[0]
+            path_parts.insert(0, parts[1])
+    return path_parts[1]
+
+def track_number(path):
+    for match in re.finditer(r'\d+', os.path.basename(path)):
+        pass
+    return int(match.group(0))
+
+def new_track_entry(srcpath, dst, looping, candidates, forcerealcopy):
+    entry = loudnessindex.get(srcpath)
+    return {
+        'track': dst,
+        'title': titles[dst-1],
+        'source': srcpath,
+        'pack': pack_name(srcpath),
+        'srctrack': track_number(srcpath),
+        'looping': looping,
+        'candidates': len(candidates),
+        'rms': entry['rms'] if entry else None,
+        'gain': round(track_gain(srcpath), 2) if forcerealcopy else 0,
+        'copied': None,
+    }
+
+def track_line(entry):
+    line = entry['title'] + ': '
+    if entry['srctrack'] != entry['track']:
+        shorttitle = titles[entry['srctrack']-1][4:]
+        line += '(' + shorttitle.strip() + ') '
+    line += entry['source']
+    if entry['rms'] is not None:
+        if entry['gain']:
+            line += f" [{entry['rms']:.1f} dB RMS, {entry['gain']:+.1f} dB gain]"
+        else:
+            line += f" [{entry['rms']:.1f} dB RMS]"
+    if entry['copied'] is False:
+        line += " [copy failed]"
+    return line
+
+# Human-readable tracklist for a manifest, in the same format as it's
+# printed to the console.
+def render_log(manifest):
+    lines = manifest['log'].copy()
+    lines.append("Non-looping tracks:")
+    lines += [track_line(entry) for entry in manifest['tracks'].values() if not entry['looping']]
+    lines.append("Looping tracks:")
+    lines += [track_line(entry) for entry in manifest['tracks'].values() if entry['looping']]
+    return lines
+
+# Write the manifest and tracklist, each to a temporary file next to the ROM
+# that then replaces the old one, so readers never see a partial manifest.
+def write_manifest(rompath, manifest, lines):
+    outputs = [
+        (f"{rompath}-msushuffleroutput.json", json.dumps(manifest, indent=2)),
+        (f"{rompath}-msushuffleroutput.log", "\n".join(lines) + "\n")]
+    for path, data in outputs:
+        tmpname = path + ".tmp"
+        try:
+            with open(tmpname, 'w') as f:
+                f.write(data)
+            os.replace(tmpname, path)
+        except PermissionError:
+            print(f"WARNING: Failed to write {path}")
+
+def delete_old_msu(args, rompath, manifest):
+    for path in [f"{rompath}-msushuffleroutput.log", f"{rompath}-msushuffleroutput.json"]:
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except PermissionError:
+            print(f"WARNING: Failed to clear old logfile {path}")
 
     if (args.dry_run):
-        logger.info("DRY RUN MODE: Printing instead of executing.")
+        log_line(manifest, "DRY RUN MODE: Printing instead of executing.")
 
     foundsrcrom = False
     foundshuffled = False
@@ -293,11 +479,11 @@ def delete_old_msu(args, rompath):
     if args.higan:
         if os.path.isdir(higandir):
             if args.dry_run:
-                logger.info("DRY RUN MODE: Would rmtree " + higandir)
+                log_line(manifest, "DRY RUN MODE: Would rmtree " + higandir)
             else:
                 shutil.rmtree(higandir)
         if args.dry_run:
-            logger.info("DRY RUN MODE: Would make " + higandir + "/msu1.rom")
+            log_line(manifest, "DRY RUN MODE: Would make " + higandir + "/msu1.rom")
         else:
             os.mkdir(higandir)
             open(higandir + "/msu1.rom", 'a').close()
@@ -305,9 +491,9 @@ def delete_old_msu(args, rompath):
     if foundsrcrom and rompath == './shuffled':
         if args.higan:
             if args.dry_run:
-                logger.info("DRY RUN MODE: Would copy " + os.path.basename(srcrom) + " to " + higandir + "/program.rom")
+                log_line(manifest, "DRY RUN MODE: Would copy " + os.path.basename(srcrom) + " to " + higandir + "/program.rom")
             else:
-                logger.info("Copying " + os.path.basename(srcrom) + " to " + higandir + "/program.rom")
+                log_line(manifest, "Copying " + os.path.basename(srcrom) + " to " + higandir + "/program.rom")
                 shutil.copy(srcrom, higandir + "/program.rom")
         else:
             replace = "Y"
@@ -315,47 +501,36 @@ def delete_old_msu(args, rompath):
                 replace = str(input("Replace shuffled.sfc with " + os.path.basename(srcrom) + "? [Y/n]") or "Y")
             if (replace == "Y") or (replace == "y"):
                 if (args.dry_run):
-                    logger.info("DRY RUN: Would rename " + os.path.basename(srcrom) + " to shuffled.sfc.")
+                    log_line(manifest, "DRY RUN: Would rename " + os.path.basename(srcrom) + " to shuffled.sfc.")
                 else:
-                    logger.info("Renaming " + os.path.basename(srcrom) + " to shuffled.sfc.")
+                    log_line(manifest, "Renaming " + os.path.basename(srcrom) + " to shuffled.sfc.")
                     shutil.move(srcrom, "./shuffled.sfc")
 
     if not args.higan:
         for path in glob.glob(f'{rompath}-*.pcm'):
             if (args.dry_run):
-                logger.info("DRY RUN: Would remove " + str(path))        
+                log_line(manifest, "DRY RUN: Would remove " + str(path))        
             else:
                 try:
                     os.remove(str(path))
                 except PermissionError:
-                    logger.info(f"WARNING: Failed to remove {path}")
+                    log_line(manifest, f"WARNING: Failed to remove {path}")
 
-def copy_track(logger, srcpath, dst, rompath, dry_run, higan, forcerealcopy, live, tmpdir):
+def copy_track(srcpath, dst, rompath, dry_run, higan, forcerealcopy, live, tmpdir, gain):
     if higan:
         dstpath = higandir + "/track-" + str(dst) + ".pcm"
     else:
         dstpath = f"{rompath}-{dst}.pcm"
 
-    for match in re.finditer(r'\d+', os.path.basename(srcpath)):
-        pass
-    srctrack = int(match.group(0))
-
-    if srctrack != dst:
-        srctitle = titles[srctrack-1]
-        shorttitle = srctitle[4:]
-        if not live:
-            logger.info(titles[dst-1] + ': (' + shorttitle.strip() + ') ' + srcpath)
-    else:
-        if not live:
-            logger.info(titles[dst-1] + ': ' + srcpath)
-
     if not dry_run:
         try:
             # Use a temporary file and os.replace to get around the fact that
             # python doesn't have an atomic copy/hardlink with overwrite.
             tmpname = os.path.join(tmpdir, f"tmp{os.path.basename(dstpath)}")
             
-            if (forcerealcopy):
+            if (forcerealcopy and gain):
+                write_normalized_track(srcpath, tmpname, gain)
+            elif (forcerealcopy):
                 shutil.copy(srcpath, tmpname)
             else:
                 os.link(srcpath, tmpname)
@@ -364,7 +539,7 @@ def copy_track(logger, srcpath, dst, rompath, dry_run, higan, forcerealcopy, liv
             return True
         except PermissionError:
             if not live:
-                logger.info(f"Failed to copy {srcpath} to {dstpath} during non-live update")
+                logging.getLogger('').info(f"Failed to copy {srcpath} to {dstpath} during non-live update")
             return False
 
 # Build a dictionary mapping each possible track number to all matching tracks
@@ -442,36 +617,175 @@ def build_index(args):
         # this is only loaded once, and plaintext may be useful for debugging.
         pickle.dump(trackindex, f, 0)
 
-def shuffle_all_tracks(rompath, fullshuffle, singleshuffle, dry_run, higan, forcerealcopy, live, nowplaying, cooldown, prevtrack):
+# Measure the RMS and peak loudness of a PCM track in dBFS.  MSU-1 PCMs are
+# an 8-byte header ("MSU1" and the loop point) followed by 16-bit
+# little-endian stereo samples; the samples are memory-mapped and scanned in
+# blocks.  Returns None for unreadable or silent tracks.
+#
+# Runs in a worker process, see analyze_index.
+def analyze_track(path):
+    try:
+        count = (os.path.getsize(path) - 8) // 2
+        if count <= 0:
+            return None
+        samples = numpy.memmap(path, dtype='<i2', mode='r', offset=8, shape=(count,))
+    except (OSError, ValueError):
+        return None
+
+    sumsquares = 0.0
+    peak = 0.0
+    for start in range(0, count, ANALYSIS_BLOCK):
+        block = samples[start:start + ANALYSIS_BLOCK].astype(numpy.float64)
+        sumsquares += float(numpy.dot(block, block))
+        peak = max(peak, float(numpy.abs(block).max()))
+    del samples
+
+    if sumsquares == 0:
+        return None
+
+    rms = 20 * math.log10(math.sqrt(sumsquares / count) / 32768)
+    return {'rms': round(rms, 2), 'peak': round(20 * math.log10(peak / 32768), 2)}
+
+# Analyse the loudness of every track in the index, spread across a process
+# pool.  Results are cached in ./trackloudness.pkl, keyed by path along with
+# the file size and mtime so unchanged tracks aren't analysed again.
+#
+# Loudness format:
+# loudnessindex['../msu1/track-2.pcm'] = {'size': 1234, 'mtime': 1.0, 'rms': -18.3, 'peak': -0.5}
+def analyze_index(args):
+    global loudnessindex
+
+    if numpy is None:
+        print("WARNING: numpy is required for --loudness and --normalize, skipping loudness analysis.")
+        return False
+
+    if os.path.exists('trackloudness.pkl'):
+        with open('trackloudness.pkl', 'rb') as f:
+            try:
+                loudnessindex = pickle.load(f)
+            except Exception as e:
+                print("Failed to load track loudness")
+
+    paths = set()
+    for track in trackindex:
+        paths.update(trackindex[track])
+
+    stale = list()
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entry = loudnessindex.get(path)
+        if not entry or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+            stale.append((path, st))
+
+    loudnessindex = {path: loudnessindex[path] for path in loudnessindex if path in paths}
+
+    if stale:
+        print(f"Analysing loudness of {len(stale)} track{'s' if len(stale) != 1 else ''}, this may take a while.")
+        analysisstarttime = datetime.datetime.now()
+
+        with ProcessPoolExecutor() as pool:
+            results = pool.map(analyze_track, [path for path, st in stale], chunksize=4)
+            for (path, st), result in zip(stale, results):
+                entry = {'size': st.st_size, 'mtime': st.st_mtime, 'rms': None, 'peak': None}
+                if result:
+                    entry.update(result)
+                loudnessindex[path] = entry
+
+        analysistime = datetime.datetime.now() - analysisstarttime
+        print(f"Loudness analysis took {analysistime.seconds}.{analysistime.microseconds} seconds")
+
+    with open('trackloudness.pkl', 'wb') as f:
+        pickle.dump(loudnessindex, f, pickle.HIGHEST_PROTOCOL)
+
+    return True
+
+# Pick the loudness window for --loudness and the target for --normalize,
+# both relative to the median loudness of the whole collection.
+def set_loudness_targets(args):
+    global loudnessbounds
+    global normalizetarget
+
+    levels = [entry['rms'] for entry in loudnessindex.values() if entry['rms'] is not None]
+    if not levels:
+        print("WARNING: No tracks could be analysed, ignoring --loudness and --normalize.")
+        return
+
+    median = statistics.median(levels)
+    if args.loudness is not None:
+        loudnessbounds = (median - args.loudness, median + args.loudness)
+    if args.normalize:
+        normalizetarget = median
+
+# Gain in dB to apply to a track when writing a normalized copy; quiet tracks
+# are only boosted as far as their peak allows without clipping.
+def track_gain(srcpath):
+    if normalizetarget is None:
+        return 0
+
+    entry = loudnessindex.get(srcpath)
+    if not entry or entry['rms'] is None:
+        return 0
+
+    gain = min(normalizetarget - entry['rms'], -entry['peak'])
+    if abs(gain) < 0.1:
+        return 0
+    return gain
+
+def write_normalized_track(srcpath, dstpath, gain):
+    scale = 10 ** (gain / 20)
+    size = os.path.getsize(srcpath)
+    count = (size - 8) // 2
+    samples = numpy.memmap(srcpath, dtype='<i2', mode='r', offset=8, shape=(count,))
+
+    with open(srcpath, 'rb') as src, open(dstpath, 'wb') as dst:
+        dst.write(src.read(8))
+        for start in range(0, count, ANALYSIS_BLOCK):
+            block = samples[start:start + ANALYSIS_BLOCK].astype(numpy.float32) * scale
+            numpy.clip(numpy.rint(block, out=block), -32768, 32767, out=block)
+            dst.write(block.astype('<i2').tobytes())
+
+        # Keep any trailing odd byte as-is.
+        src.seek(8 + count * 2)
+        dst.write(src.read())
+    del samples
+
+# Pick a random track from the candidates, limited to the --loudness window
+# when one is set.  Falls back to all candidates if none of them are in the
+# window.
+def pick_track(candidates):
+    if loudnessbounds:
+        low, high = loudnessbounds
+        bounded = list()
+        for path in candidates:
+            entry = loudnessindex.get(path)
+            if entry and entry['rms'] is not None and low <= entry['rms'] <= high:
+                bounded.append(path)
+        if bounded:
+            candidates = bounded
+    return random.choice(candidates)
+
+def shuffle_all_tracks(rompath, manifest, fullshuffle, singleshuffle, dry_run, higan, forcerealcopy, live, nowplaying, cooldown, prevstates):
     logger = logging.getLogger('')
     #For all found non-looping tracks, pick a random track with a matching
     #track number from a random pack in the target directory.
     shufflestarttime = datetime.datetime.now()
 
-    if not live:
-        logger.info("Non-looping tracks:")
-
     if cooldown == 0:
         with TemporaryDirectory(dir='.') as tmpdir:
-            oldwinnerdict = {}
-            if os.path.exists('winnerdict.pkl'):
-                with open('winnerdict.pkl', 'rb') as f:
-                    try:
-                        oldwinnerdict = pickle.load(f)
-                    except Exception as e:
-                        print("Failed to load tracklist")
-            winnerdict = {}
+            oldtracks = manifest['tracks']
+            tracks = {}
             for i in nonloopingfoundtracks:
-                winner = random.choice(trackindex[i])
-                winnerdict[i] = winner
-                copy_track(logger, winner, i, rompath, dry_run, higan, forcerealcopy, live, tmpdir)
+                entry = new_track_entry(pick_track(trackindex[i]), i, False, trackindex[i], forcerealcopy)
+                entry['copied'] = copy_track(entry['source'], i, rompath, dry_run, higan, forcerealcopy, live, tmpdir, entry['gain'])
+                tracks[i] = entry
 
             #For all found looping tracks, pick a random track from a random pack
             #in the target directory, with a matching track number by default, or
             #a shuffled different looping track number if fullshuffle or
             #singleshuffle are enabled.
-            if not live:
-                logger.info("Looping tracks:")
             for i in loopingfoundtracks:
                 if (args.fullshuffle or args.singleshuffle):
                     dst = i
@@ -479,16 +793,22 @@ def shuffle_all_tracks(rompath, fullshuffle, singleshuffle, dry_run, higan, forc
                 else:
                     dst = i
                     src = i
-                winner = random.choice(trackindex[src])
-                copied = copy_track(logger, winner, dst, rompath, dry_run, higan, forcerealcopy, live, tmpdir)
-                # if copy failed, use OLD winner...
-                if copied:
-                    winnerdict[i] = winner
-                elif i in oldwinnerdict:
-                    winnerdict[i] = oldwinnerdict[i]
-
-            with open('winnerdict.pkl', 'wb') as f:
-                pickle.dump(winnerdict, f, pickle.HIGHEST_PROTOCOL)
+                entry = new_track_entry(pick_track(trackindex[src]), dst, True, trackindex[src], forcerealcopy)
+                entry['copied'] = copy_track(entry['source'], dst, rompath, dry_run, higan, forcerealcopy, live, tmpdir, entry['gain'])
+                # if copy failed, the OLD track is still in place...
+                if entry['copied'] is False and i in oldtracks:
+                    tracks[i] = oldtracks[i]
+                else:
+                    tracks[i] = entry
+
+        manifest['tracks'] = tracks
+        manifests[rompath] = manifest
+        lines = render_log(manifest)
+        write_manifest(rompath, manifest, lines)
+        if not live:
+            for line in lines[len(manifest['log']):]:
+                logger.info(line)
+
         if live:
             cooldown = int(live)
             if not nowplaying:
@@ -497,9 +817,8 @@ def shuffle_all_tracks(rompath, fullshuffle, singleshuffle, dry_run, higan, forc
 
     if live:
         if nowplaying:
-            newtrack = read_track(prevtrack)
-            prevtrack = newtrack
-        s.enter(1, 1, shuffle_all_tracks, argument=(rompath, fullshuffle, singleshuffle, dry_run, higan, forcerealcopy, live, nowplaying, cooldown - 1, prevtrack))
+            prevstates = read_track(rompath, prevstates)
+        s.enter(1, 1, shuffle_all_tracks, argument=(rompath, manifest, fullshuffle, singleshuffle, dry_run, higan, forcerealcopy, live, nowplaying, cooldown - 1, prevstates))
 
 async def recv_loop(ws, recv_queue):
     try:
@@ -508,34 +827,57 @@ async def recv_loop(ws, recv_queue):
     finally:
         await ws.close()
 
-# Print the track that's currently playing, and print its pack to
-# nowplaying.txt which can be used as a streaming text file source.
-def print_pack(path):
-    print("Now playing: " + path)
-    path_parts = list()
-    while True:
-        parts = os.path.split(path)
-        if parts[0] == path:
-            path_parts.insert(0, parts[0])
-            break
-        elif parts[1] == path:
-            path_parts.insert(0, parts[1])
-            break
-        else:
-            path = parts[0]
-            path_parts.insert(0, parts[1])
-    with open('nowplaying.txt', 'w') as f:
+# Output file for each attached device; the first device keeps writing to
+# nowplaying.txt so existing OBS text sources keep working.
+def nowplaying_output(index):
+    if index == 0:
+        return 'nowplaying.txt'
+    return f'nowplaying-{index + 1}.txt'
+
+# Describe where the player currently is from the polled game state, or an
+# empty string outside of the overworld and dungeons (menus, cutscenes, etc.)
+def describe_location(state):
+    if state['module'] == 0x07:
+        return dungeonnames.get(state['dungeon'], "Cave")
+    elif state['module'] == 0x09 or state['module'] == 0x0B:
+        world = "Dark World" if state['overworld'] & 0x40 else "Light World"
+        return f"{world} overworld screen {state['overworld']:02X}"
+    return ""
+
+# Print the pack of the track that's currently playing on one device to its
+# nowplaying output, which can be used as a streaming text file source.
+def print_pack(pack, output, location):
+    with open(output, 'w') as f:
         f.truncate(0)
         print("MSU pack now playing:", file=f)
-        print(path_parts[1], file=f)
+        print(pack, file=f)
+        if location:
+            print(location, file=f)
 
-async def query(prevtrack):
+async def attach_device(addr, name):
+    ws = await websockets.connect(addr, ping_timeout=None, ping_interval=None)
+    attachreq = {
+        "Opcode": "Attach",
+        "Space": "SNES",
+        "Operands": [name]
+    }
+    await ws.send(json.dumps(attachreq))
+
+    recv_queue = asyncio.Queue()
+    recv_task = asyncio.create_task(recv_loop(ws, recv_queue))
+    return {'name': name, 'ws': ws, 'queue': recv_queue, 'task': recv_task}
+
+# qusb2snes only allows one attached device per connection, so open one
+# connection per device and attach to all of them concurrently.  These
+# connections are kept open between polls.
+async def connect_devices():
+    global snesdevices
     addr = "ws://localhost:8080"
     try:
         ws = await websockets.connect(addr, ping_timeout=None, ping_interval=None)
     except Exception as e:
         print("Failed to connect to qusb2snes")
-        return 0
+        return
 
     devlist = {
         "Opcode": "DeviceList",
@@ -543,73 +885,109 @@ async def query(prevtrack):
     }
     await ws.send(json.dumps(devlist))
     reply = json.loads(await ws.recv())
+    await ws.close()
     devices = reply['Results'] if 'Results' in reply and len(reply['Results']) > 0 else None
     if not devices:
         print("Failed to connect to SNES through qusb2snes")
-        await ws.close()
-        return 0
-
-    device = devices[0]
-    attachreq = {
-        "Opcode": "Attach",
-        "Space": "SNES",
-        "Operands": [device]
-    }
-    await ws.send(json.dumps(attachreq))
-
-    recv_queue = asyncio.Queue()
-    recv_task = asyncio.create_task(recv_loop(ws, recv_queue))
-    WRAM_START = 0xF50000
+        return
 
-    # Current MSU is $010B, per https://github.com/KatDevsGames/z3randomizer/blob/master/msu.asm#L126
-    REG_CURRENT_MSU_TRACK = 0x010B
+    results = await asyncio.gather(*[attach_device(addr, name) for name in devices], return_exceptions=True)
+    for index, (name, device) in enumerate(zip(devices, results)):
+        if isinstance(device, Exception):
+            print(f"Failed to attach to {name} through qusb2snes")
+            continue
+        device['output'] = nowplaying_output(index)
+        snesdevices.append(device)
+
+async def disconnect_devices():
+    global snesdevices
+    for device in snesdevices:
+        device['task'].cancel()
+        await device['ws'].close()
+    snesdevices = list()
+
+# Read all of the nowplayingreads WRAM ranges from one device with a single
+# batched GetAddress request.  Returns None if the device didn't reply.
+async def read_device(device):
+    operands = list()
+    readsize = 0
+    for name, offset, size in nowplayingreads:
+        operands += [hex(WRAM_START + offset)[2:], hex(size)[2:]]
+        readsize += size
+
+    # Drop any late reply to a previous poll that timed out.
+    while not device['queue'].empty():
+        device['queue'].get_nowait()
 
-    address = WRAM_START + REG_CURRENT_MSU_TRACK
-    size = 1
     readreq = {
         "Opcode": "GetAddress",
         "Space": "SNES",
-        "Operands": [hex(address)[2:], hex(size)[2:]]
+        "Operands": operands
     }
-    await ws.send(json.dumps(readreq))
+    await device['ws'].send(json.dumps(readreq))
     data = bytes()
-    while len(data) < 1:
+    while len(data) < readsize:
         try:
-            data += await asyncio.wait_for(recv_queue.get(), 1)
+            data += await asyncio.wait_for(device['queue'].get(), 1)
         except asyncio.TimeoutError:
             break
 
-    track = 0
-    if len(data) != 1:
-        print("Failed to query REG_CURRENT_MSU_TRACK")
-    else:
-        track = int(data[0])
-
-    if track != 0 and track != prevtrack:
-        if os.path.exists('winnerdict.pkl'):
-            winnerdict = {}
-            with open('winnerdict.pkl', 'rb') as f:
-                try:
-                    winnerdict = pickle.load(f)
-                    print_pack(str(winnerdict[track]))
-                except Exception as e:
-                    print("Failed to load tracklist")
-
-    await ws.close()
-    return track
-
-# Read the currently playing track over qusb2snes.
-# TODO: This currently opens up a new qusb2snes connection every second.
-# Eventually this should be smarter by keeping one connection alive instead.
-def read_track(prevtrack):
-    track = asyncio.get_event_loop().run_until_complete(query(prevtrack))
-    return track
-
-def generate_shuffled_msu(args, rompath):
+    if len(data) != readsize:
+        return None
+
+    state = {}
+    pos = 0
+    for name, offset, size in nowplayingreads:
+        state[name] = int.from_bytes(data[pos:pos + size], 'little')
+        pos += size
+    return state
+
+# Poll every attached device concurrently, so a poll takes about as long as
+# the slowest device rather than the sum of all of them.
+async def query(rompath, prevstates):
+    if not snesdevices:
+        await connect_devices()
+
+    results = await asyncio.gather(*[read_device(device) for device in snesdevices], return_exceptions=True)
+
+    states = {}
+    tracks = manifests[rompath]['tracks'] if rompath in manifests else {}
+    failed = False
+    for device, state in zip(snesdevices, results):
+        if isinstance(state, Exception) or state is None:
+            print(f"Failed to query {device['name']}")
+            failed = True
+            continue
+
+        track = state['track']
+        location = describe_location(state)
+        states[device['name']] = {'track': track, 'location': location}
+        prevstate = prevstates.get(device['name'], {'track': 0, 'location': ""})
+        if track == 0 or (track == prevstate['track'] and location == prevstate['location']):
+            continue
+
+        if track in tracks:
+            if track != prevstate['track']:
+                print(f"Now playing on {device['name']}: {tracks[track]['source']}")
+            print_pack(tracks[track]['pack'], device['output'], location)
+
+    # Reattach everything on the next poll if any device went away.
+    if failed:
+        await disconnect_devices()
+
+    return states
+
+# Read the currently playing track and game state from every device over
+# qusb2snes.
+def read_track(rompath, prevstates):
+    states = asyncio.get_event_loop().run_until_complete(query(rompath, prevstates))
+    return states
+
+def generate_shuffled_msu(args, rompath, manifest):
     logger = logging.getLogger('')
 
     if (not os.path.exists(f'{rompath}.msu')):
-        logger.info(f"'{rompath}.msu' doesn't exist, creating it.")
+        log_line(manifest, f"'{rompath}.msu' doesn't exist, creating it.")
         if (not args.dry_run):
             with open(f'{rompath}.msu', 'w'):
                 pass
@@ -633,10 +1011,10 @@ def generate_shuffled_msu(args, rompath):
     nonloopingfoundtracks = [i for i in foundtracks if i in nonloopingtracks]
 
     if args.live:
-        s.enter(1, 1, shuffle_all_tracks, argument=(rompath, args.fullshuffle, args.singleshuffle, args.dry_run, args.higan, args.forcerealcopy, args.live, args.nowplaying, int(args.live), 0))
+        s.enter(1, 1, shuffle_all_tracks, argument=(rompath, manifest, args.fullshuffle, args.singleshuffle, args.dry_run, args.higan, args.forcerealcopy, args.live, args.nowplaying, int(args.live), {}))
         s.run()
     else:
-        shuffle_all_tracks(rompath, args.fullshuffle, args.singleshuffle, args.dry_run, args.higan, args.forcerealcopy, args.live, args.nowplaying, 0, 0)
+        shuffle_all_tracks(rompath, manifest, args.fullshuffle, args.singleshuffle, args.dry_run, args.higan, args.forcerealcopy, args.live, args.nowplaying, 0, {})
         logger.info('Done.')
 
 def main(args):
@@ -647,6 +1025,10 @@ def main(args):
 
     build_index(args)
 
+    if args.loudness is not None or args.normalize:
+        if analyze_index(args):
+            set_loudness_targets(args)
+
     for rom in args.roms:
         args.forcerealcopy = args.realcopy
         try:
@@ -659,8 +1041,9 @@ def main(args):
         if args.live and args.forcerealcopy:
             print("WARNING: live updates with real copies will cause a LOT of disk usage.")
 
-        delete_old_msu(args, rom)
-        generate_shuffled_msu(args, rom)
+        manifest = new_manifest(args, rom)
+        delete_old_msu(args, rom, manifest)
+        generate_shuffled_msu(args, rom, manifest)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -672,7 +1055,9 @@ if __name__ == '__main__':
     parser.add_argument('--realcopy', help='Creates real copies of the source tracks instead of hardlinks', action='store_true', default=False)
     parser.add_argument('--dry-run', help='Makes script print all filesystem commands that would be executed instead of actually executing them.', action='store_true', default=False)
     parser.add_argument('--live', help='The interval at which to re-shuffle the entire pack, in seconds; will skip tracks currently in use.')
-    parser.add_argument('--nowplaying', help='EXPERIMENTAL: During live reshuffling, connect to qusb2snes to print the currently playing MSU pack to console and nowplaying.txt', action='store_true', default=False)
+    parser.add_argument('--nowplaying', help='EXPERIMENTAL: During live reshuffling, connect to qusb2snes to print the currently playing MSU pack on every attached device to console and nowplaying.txt (nowplaying-2.txt etc. for additional devices)', action='store_true', default=False)
+    parser.add_argument('--loudness', type=float, help='Only pick tracks whose RMS loudness is within this many dB of the median loudness of all tracks, to avoid jumping between very quiet and very loud packs.  Requires numpy.')
+    parser.add_argument('--normalize', help='With --realcopy, write copies of each track with their gain adjusted towards the median loudness of all tracks (without clipping).  Requires numpy.', action='store_true', default=False)
     parser.add_argument('--reindex', help='Rebuild the index of MSU packs, this must be run to pick up any new packs or moved/deleted files in existing packs!', action='store_true', default=False)
     parser.add_argument('--version', help='Print version number and exit.', action='store_true', default=False)
 
@@ -695,6 +1080,9 @@ if __name__ == '__main__':
         parser.print_help()
         sys.exit()
 
+    if args.normalize and not args.realcopy:
+        print("WARNING: --normalize only applies to real copies, use it with --realcopy.")
+
     if args.live and int(args.live) < 1:
         print("WARNING, can't choose live updates shorter than 1 second, defaulting to 1 second")
         args.live = 1